@@ -1,18 +1,51 @@
-from flask import Flask, Blueprint, request
-from flask_restplus import Resource, Api, Namespace, fields, reqparse
+from flask import Flask, Blueprint, Request, Response, request
+from flask_restx import Resource, Api, Namespace, fields, reqparse, inputs
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, select, bindparam
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import sqlalchemy_utils
 from contextlib import contextmanager
 from flask_marshmallow import Marshmallow
-from apscheduler.schedulers.background import BackgroundScheduler
-import os
-import arrow
 import atexit
+import collections
+import hashlib
+import heapq
+import os
+import threading
+import time
+import uuid
+import orjson
+
+
+# Parse JSON request bodies with orjson instead of the standard json module
+# The payload validation and api.payload both go through get_json, so every body is parsed once and in C
+class OrjsonRequest(Request):
+    _json_payload = None
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self._json_payload is not None:
+            return self._json_payload
+        if not (force or self.is_json):
+            return None
+        try:
+            payload = orjson.loads(self.get_data(cache=cache))
+        except orjson.JSONDecodeError as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._json_payload = payload
+        return payload
 
 
 # Init flask app
 app = Flask(__name__)
+app.request_class = OrjsonRequest
+# Compact separators for the responses that are still serialized by flask restx
+app.config['RESTX_JSON'] = {'separators' : (',', ':')}
 # A fix for the Flask reverse proxy problem
 app.wsgi_app = ProxyFix(app.wsgi_app)
 # Add a blueprint to move the api end point
@@ -30,12 +63,32 @@ database_path = os.path.join(basedir, 'Database/GameServers.db')
 # Database
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database_path
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Share a pool of connections between the request threads and the inactivity sweeper
+# instead of opening a new one for each thread
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass' : QueuePool,
+    'pool_size' : 8,
+    'max_overflow' : 16,
+    'pool_pre_ping' : True,
+    'connect_args' : {'check_same_thread' : False, 'timeout' : 5}
+}
 
 # Init SQLAlchemy DB
 db = SQLAlchemy(app)
 # Init Marshmallow
 ma = Marshmallow(app)
 
+# Use WAL so the requests can keep reading while the inactivity sweeper is writing
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    # Read the database pages through a memory map instead of a read syscall each
+    cursor.execute('PRAGMA mmap_size=268435456')
+    cursor.close()
+
 # "servers" resource RESTful API endpoint definitions
 servers_api = Namespace('servers')
 api.add_namespace(servers_api)
@@ -54,62 +107,218 @@ def dbsession():
     finally:
         session.close()
 
+# Timestamps are stored as unix time in integer milliseconds, so comparing them is cheap
+# and servers that check in within the same second are still ordered
+def to_timestamp(seconds):
+    return int(seconds * 1000)
+
+def current_timestamp():
+    return to_timestamp(time.time())
+
+
 # Game server database table definition
 class Server(db.Model):
     url = db.Column(db.String, primary_key=True)
     name = db.Column(db.String())
     game_id = db.Column(db.Integer)
-    registration_time = db.Column(sqlalchemy_utils.ArrowType, default=arrow.now())
+    # Refreshed on every insert and update, this is what the inactivity sweeper checks
+    registration_time = db.Column(db.Integer, default=current_timestamp, onupdate=current_timestamp)
     ip = db.Column(sqlalchemy_utils.IPAddressType)
     port = db.Column(db.Integer)
-    game_mode = db.Column(db.String())
-    game_map = db.Column(db.String())
+    game_mode = db.Column(db.String(), index=True)
+    game_map = db.Column(db.String(), index=True)
     current_players = db.Column(db.Integer, default=0)
     max_players = db.Column(db.Integer)
     active = db.Column(db.Boolean, default=True)
 
-    def args2query(query_args):
-        # Get the values from args and construct a query based on them
-        game_id = query_args['game_id']
-        game_mode = query_args['game_mode']
-        game_map = query_args['game_map']
-        max_players = query_args['max_players']
-        active = query_args['active']
-        slots = query_args['slots']
+    __table_args__ = (
+        # Lets /latest and the inactivity sweeper seek the active servers by registration time instead of scanning the table
+        db.Index('ix_server_active_regtime', 'active', 'registration_time'),
+        # Game clients mostly ask /latest for a server of their own game, which this answers with a single seek
+        db.Index('ix_server_active_game_regtime', 'active', 'game_id', 'registration_time'),
+        # The server list is mostly filtered by game and then by mode and map, this narrows down all of them at once
+        db.Index('ix_server_game_mode_map', 'game_id', 'game_mode', 'game_map'),
+    )
 
-        query = Server.query
 
-        if game_id:
-            query = query.filter(Server.game_id == game_id)
-        
-        if game_mode:
-            query = query.filter(Server.game_mode == game_mode)
+# Clients send blank optional args, an arg is only applied if it has a value, but 0 and false count as values
+def query_arg_given(value):
+    return value is not None and value != ''
 
-        if game_map:
-            query = query.filter(Server.game_map == game_map)
-        
-        if max_players:
-            query = query.filter(Server.max_players <= max_players)
 
-        if active:
-            query = query.filter(Server.active == active)
-        # slots = current number of players - max number of players
-        if slots:
-            query = query.filter( Server.current_players <= (Server.max_players - slots) )
-
-        return query
+# The criteria get_server_query_statement builds for each of the query args that was given
+server_query_criteria = (
+    ('game_id', lambda game_id: Server.game_id == game_id),
+    ('game_mode', lambda game_mode: Server.game_mode == game_mode),
+    ('game_map', lambda game_map: Server.game_map == game_map),
+    ('max_players', lambda max_players: Server.max_players <= max_players),
+    ('active', lambda active: Server.active == active),
+    # slots = current number of players - max number of players
+    ('slots', lambda slots: Server.current_players <= (Server.max_players - slots)),
+)
 
 
 # Serialization/Deserialization schema definition
-class ServerSchema(ma.ModelSchema):
+# The fields are declared the way ModelSchema generated them from the columns, instead of reflecting the model,
+# and the data is loaded into a plain dict instead of a Server instance
+class ServerSchema(ma.Schema):
     strict = True
+    url = ma.String(required=True)
+    game_id = ma.Integer(allow_none=True)
+    name = ma.String(allow_none=True)
+    game_mode = ma.String(allow_none=True)
+    game_map = ma.String(allow_none=True)
+    port = ma.Integer(allow_none=True)
+    # The column default isn't applied to the upsert values, which always carry every field
+    current_players = ma.Integer(missing=0)
+    max_players = ma.Integer(allow_none=True)
     class Meta:
-        model = Server
         fields = ('url', 'game_id', 'name', 'game_mode', 'game_map',
                     'port', 'current_players', 'max_players')    
 
 
-# Server model for the interactive flask restplus documentation
+# Created once instead of on every request
+server_schema = ServerSchema()
+
+
+# Marshmallow is only used to validate incoming server data,
+# responses are built from plain dicts and serialized with orjson which is a lot faster
+def server_to_dict(server):
+    return {field: getattr(server, field) for field in ServerSchema.Meta.fields}
+
+def json_response(data, status=200):
+    return Response(orjson.dumps(data), status=status, mimetype='application/json')
+
+# Tagged with a hash of the body, so clients that already have it get a 304 Not Modified with no body
+def conditional_json_response(data):
+    response = json_response(data)
+    response.set_etag(hashlib.blake2b(response.get_data(), digest_size=8).hexdigest())
+    return response.make_conditional(request)
+
+
+# Register a server or update its info if its url is already registered, in a single statement
+# The queued rows carry the registration time and active flag, so an update also sets the server active and refreshes its registration time
+server_upsert = sqlite_insert(Server.__table__)
+server_upsert = server_upsert.on_conflict_do_update(
+                    index_elements=['url'],
+                    set_={column : server_upsert.excluded[column]
+                            for column in ServerSchema.Meta.fields + ('registration_time', 'active')
+                            if column != 'url'})
+
+
+# Selects only the public fields as plain rows, for listing servers without building Server objects
+server_list_select = select(*[getattr(Server, field) for field in ServerSchema.Meta.fields])
+
+
+# In-memory registry of the known servers, keyed by their url
+# Listing the servers is by far the most common request, so it's served from here instead of the database
+server_cache = {}
+# Every entry is serialized once when it changes,
+# so rebuilding the list after a change only has to join them instead of encoding every server again
+server_cache_rows = {}
+# The serialized server list, rebuilt lazily the first time it's requested after a change
+server_cache_json = None
+# Bumped on every change and sent as the list ETag, so polling clients get a 304 while nothing changed
+# The random prefix keeps the ETags of a restarted process from matching the old ones
+server_cache_version = 0
+server_cache_etag_prefix = uuid.uuid4().hex[:8]
+server_cache_lock = threading.RLock()
+
+def cache_server(data):
+    global server_cache_json, server_cache_version
+    with server_cache_lock:
+        # Most check-ins don't change anything, keep the ETag and the serialized list for those
+        if server_cache.get(data['url']) == data:
+            return
+        server_cache[data['url']] = data
+        server_cache_rows[data['url']] = orjson.dumps(data)
+        server_cache_json = None
+        server_cache_version += 1
+
+def uncache_server(url):
+    global server_cache_json, server_cache_version
+    with server_cache_lock:
+        del server_cache[url]
+        del server_cache_rows[url]
+        server_cache_json = None
+        server_cache_version += 1
+
+def get_server_cache_etag():
+    return f'{server_cache_etag_prefix}-{server_cache_version}'
+
+
+# Serialized responses of the server queries that go to the database, keyed by the query and its args
+# Clients of the same game keep sending the same queries, so most of them are answered from here
+# Only the background writer and sweeper change the server table, and they drop the cache after every write,
+# so a cached response is never older than the data in the database
+# Kept in least recently used order, the keys come from the clients so the number of entries is capped
+server_query_cache = collections.OrderedDict()
+server_query_cache_size = 1024
+# The entries also expire, so queries nobody repeats don't stay around while the table isn't written
+server_query_cache_ttl = 2.0
+# Bumped on every drop, so a query that read the table before a write doesn't put its result back in afterwards
+server_query_cache_generation = 0
+server_query_cache_lock = threading.Lock()
+
+# Returns the cached JSON of the query, or runs it with run_query and caches it, None means no servers matched
+def get_cached_server_query(key, run_query):
+    with server_query_cache_lock:
+        entry = server_query_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            server_query_cache.move_to_end(key)
+            return entry[1]
+        generation = server_query_cache_generation
+
+    data = run_query()
+
+    with server_query_cache_lock:
+        if generation == server_query_cache_generation:
+            server_query_cache[key] = (time.monotonic() + server_query_cache_ttl, data)
+            server_query_cache.move_to_end(key)
+            if len(server_query_cache) > server_query_cache_size:
+                server_query_cache.popitem(last=False)
+    return data
+
+def clear_server_query_cache():
+    global server_query_cache_generation
+    with server_query_cache_lock:
+        server_query_cache.clear()
+        server_query_cache_generation += 1
+
+
+# Create the database tables and indexes that don't exist yet
+def create_database():
+    db.create_all()
+    # registration_time used to be stored as a date string, and then as unix time in seconds,
+    # convert the rows of older databases to milliseconds
+    with dbsession():
+        Server.query.\
+            filter(db.func.typeof(Server.registration_time) == 'text').\
+            update({Server.registration_time : db.cast(db.func.strftime('%s', Server.registration_time), db.Integer) * 1000},
+                    synchronize_session=False)
+        # Any time in milliseconds is past this, it's in 1973
+        Server.query.\
+            filter(Server.registration_time < 100000000000).\
+            update({Server.registration_time : Server.registration_time * 1000},
+                    synchronize_session=False)
+    # create_all skips the tables that already exist,
+    # so indexes added after the database was created have to be created separately
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+# Fill the registry from the database once, later changes are applied by the handlers
+def load_server_cache():
+    now = time.time()
+    for server in Server.query.all():
+        cache_server(server_to_dict(server))
+        # Give the servers that were active a full interval to check in with this process
+        if server.active:
+            track_server_check_in(server.url, now)
+
+
+# Server model for the interactive flask restx documentation
 # You can remove this if you don't care about the auto-generated docs
 api_server_model = api.model('Server',
                     {
@@ -179,7 +388,7 @@ server_request_parser.add_argument(
 
 server_request_parser.add_argument(
                         'active',
-                        type=bool,
+                        type=inputs.boolean,
                         required=False, 
                         help='Whether to only get active (recently checked in) servers or inactive ones')
 
@@ -195,37 +404,93 @@ server_request_parser.add_argument(
                         required=False,
                         help='Limit the number of results to this number')
 
+# The column names of each model, collected once instead of walking the table columns on every call
+model_column_names = {}
+
 def get_model_dict(model):
-    return dict((column.name, getattr(model, column.name)) 
-                for column in model.__table__.columns)
+    model_class = type(model)
+    if model_class not in model_column_names:
+        model_column_names[model_class] = tuple(column.name for column in model.__table__.columns)
+    return {name : getattr(model, name) for name in model_column_names[model_class]}
+
+
+# The statements of the server list and /latest for each combination of query args, built on first use
+# The criteria compare against bind parameters, so later requests with the same args only bind their values
+# instead of building the statement and its cache key again
+server_query_statements = {}
+
+def get_server_query_statement(query_args, latest=False):
+    args = tuple(arg for arg, make_criterion in server_query_criteria if query_arg_given(query_args.get(arg)))
+    limit = query_args['limit']
+    # Only positive limits are applied
+    limited = bool(limit and limit > 0)
+
+    statement = server_query_statements.get((args, limited, latest))
+    if statement is None:
+        statement = server_list_select.where(*[make_criterion(bindparam(arg))
+                                                for arg, make_criterion in server_query_criteria if arg in args])
+        if latest:
+            statement = statement.order_by(Server.registration_time.desc()).limit(1)
+        elif limited:
+            statement = statement.limit(bindparam('limit'))
+        server_query_statements[(args, limited, latest)] = statement
+
+    params = {arg : query_args[arg] for arg in args}
+    if limited and not latest:
+        params['limit'] = limit
+    return statement, params
+
+
+# The database queries behind the server list and /latest, their results are cached by get_cached_server_query
+def query_servers_json(query_args):
+    # Execute the query
+    servers = db.session.execute(*get_server_query_statement(query_args)).mappings().all()
+    if servers:
+        return orjson.dumps([dict(server) for server in servers])
+
+def query_latest_server_json(query_args):
+    # Get the latest registered active server, only selecting its public fields like the server list
+    server = db.session.execute(*get_server_query_statement(query_args, latest=True)).mappings().first()
+    if server:
+        return orjson.dumps(dict(server))
 
 
 @servers_api.route('/')
 class ServersList(Resource):
 
     @servers_api.response(200, 'A list of all servers', [api_server_model])
+    @servers_api.response(304, 'The server list did not change since the ETag sent in If-None-Match')
     @servers_api.response(404, 'Found no servers')
-    @servers_api.expect(server_request_parser, validate=True)
+    @servers_api.expect(server_request_parser)
     def get(self):
         """
         Query game servers
 
         <h3>Get a list of all servers that match a certain query</h3>
         """
+        global server_cache_json
         query_args = server_request_parser.parse_args()
-        # Only the model specific args are processed in the model
-        query = Server.args2query(query_args)
-        
-        limit = query_args['limit']
 
-        if limit and limit > 0:
-            query = query.limit(limit)
-        
-        # Execute the query
-        servers = query.all()
-        data = ServerSchema(many=True).dump(servers).data
-        if servers:
-            return data, 200
+        # Without any filters the whole list is served from the in-memory registry
+        if not any(query_arg_given(value) for value in query_args.values()):
+            with server_cache_lock:
+                if not server_cache:
+                    return {'message' : 'No servers found'}, 404
+                etag = get_server_cache_etag()
+                if request.if_none_match.contains_weak(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag, weak=True)
+                    return response
+                if server_cache_json is None:
+                    server_cache_json = b'[' + b','.join(server_cache_rows.values()) + b']'
+                response = Response(server_cache_json, mimetype='application/json')
+                response.set_etag(etag, weak=True)
+                return response
+
+        servers_json = get_cached_server_query(('list', tuple(sorted(query_args.items()))),
+                                                lambda: query_servers_json(query_args))
+        if servers_json:
+            return Response(servers_json, mimetype='application/json')
         else:
             return {'message' : 'No servers found'}, 404
 
@@ -241,32 +506,35 @@ class ServersList(Resource):
         """
         # Create the url form the server ip and the dedicated server port
         # The client address if the address of the http client if one is not provided
-        client_addr = request.remote_addr
-        if 'ip' in api.payload:
-            client_addr = api.payload['ip']
+        payload = api.payload
+        if 'ip' in payload:
+            client_addr = payload['ip']
         else:
-            api.payload['ip'] = request.remote_addr
+            client_addr = payload['ip'] = request.remote_addr
         #client_addr = api.payload['ip'] if 'ip' in api.payload and api.payload['ip'] else request.remote_addr
-        api.payload['url'] = '{}:{}'.format(client_addr, api.payload['port'])
+        payload['url'] = f"{client_addr}:{payload['port']}"
 
         
         # validate and deserialize the data
-        new_server = ServerSchema().load(api.payload)
+        new_server = server_schema.load(payload)
+        server_data = {field : new_server.data.get(field) for field in ServerSchema.Meta.fields}
 
-        new_server_row = Server.query.get(new_server.data.url)
-        # If the server already exists, update all its info and set it to active
+        # The clock is read once, so the stored registration time and the sweeper's deadline agree
+        check_in_time = time.time()
+
+        # The check-in is tracked while holding the registry, so pruning can't remove the server in between
+        with server_cache_lock:
+            registered = server_data['url'] in server_cache
+            cache_server(server_data)
+            track_server_check_in(server_data['url'], check_in_time)
         # A server is defined only by its url so the game mode or map could change at any time
-        if new_server_row:
-            with dbsession():
-                new_server_row.active = True
-                new_server_row.registration_time = arrow.now()
-                Server.query.filter_by(url=new_server.data.url).update(get_model_dict(new_server.data))
+        queue_server_write(server_data, check_in_time)
+
+        # If the server already exists, its info was updated and it was set to active
+        if registered:
             return {'message' : 'Server info updated'}, 200
-        # If this is the first time the server is registering with us,
-        # then create a new entry for it in the database
+        # Otherwise this is the first time the server is registering with us
         else:
-            with dbsession():
-                db.session.add(new_server.data)
             return {'message' : 'Server Registered'}, 201
 
 
@@ -275,7 +543,7 @@ class ServerLatest(Resource):
     
     @servers_api.response(200, 'The latest checked-in active server matching query')
     @servers_api.response(404, 'No active servers matching query found')
-    @servers_api.expect(server_request_parser, validate=True)
+    @servers_api.expect(server_request_parser)
     def get(self):
         """
         Request an active game server
@@ -285,16 +553,19 @@ class ServerLatest(Resource):
         query_args = server_request_parser.parse_args()
         # Force only active servers when getting the latest server
         query_args['active'] = True
-        query = Server.args2query(query_args)
 
-        # Get the latest registered active server
-        server = query.order_by(Server.registration_time.desc()).first_or_404()
-        return ServerSchema().jsonify(server)
+        server_json = get_cached_server_query(('latest', tuple(sorted(query_args.items()))),
+                                                lambda: query_latest_server_json(query_args))
+        if server_json:
+            return Response(server_json, mimetype='application/json')
+        else:
+            return {'message' : 'No active servers found'}, 404
 
 @servers_api.route('/<string:server_url>')
 class ServerByURL(Resource):
 
     @servers_api.response(200, 'The server info', api_server_model)
+    @servers_api.response(304, 'The server info did not change since the ETag sent in If-None-Match')
     @servers_api.response(404, 'Found no servers with this URL')
     def get(self, server_url):
         """
@@ -302,8 +573,12 @@ class ServerByURL(Resource):
 
         <h3>Get the info of the server matching the URL</h3>
         """
-        server = Server.query.get_or_404(server_url)
-        return ServerSchema().jsonify(server)
+        # Served from the registry, the database may not have the latest check-in written yet
+        server = server_cache.get(server_url)
+        if server:
+            return conditional_json_response(server)
+        else:
+            return {'message' : 'No such server'}, 404
 
     # server check in
     @servers_api.response(200, 'Server info updated')
@@ -315,55 +590,254 @@ class ServerByURL(Resource):
 
         <h3>Update the info of the server matching the url</h3>
         """
+        payload = api.payload
+        payload['url'] = server_url
         # validate and deserialize the data
-        new_server_info = ServerSchema().load(api.payload)
+        new_server_info = server_schema.load(payload)
+        # Only update the info that was sent, so a plain check-in doesn't have to send anything
+        server_info = {field : new_server_info.data.get(field)
+                        for field in ServerSchema.Meta.fields if field in payload and field != 'url'}
+
+        # The clock is read once, so the stored registration time and the sweeper's deadline agree
+        check_in_time = time.time()
+
+        # The registry holds every registered server, so it can tell if this one exists without a query
+        with server_cache_lock:
+            # If the server is not registered before then return an 404
+            if server_url not in server_cache:
+                return {'error' : "Server doesn't exist"}, 404
+            server_data = dict(server_cache[server_url], **server_info)
+            cache_server(server_data)
+            track_server_check_in(server_url, check_in_time)
+        # Set the server to active and refresh its registration time
+        queue_server_write(server_data, check_in_time)
+        return {'message' : 'Server info updated'}, 200
+
+
+# Registers and check-ins are written to the database in batches instead of one transaction each
+# The registry is updated right away, only the database lags behind by up to 'server_write_delay'
+server_write_delay = 0.2
+# The latest row of every server waiting to be written, keyed by url, so repeated check-ins only write once
+server_pending_writes = {}
+server_write_lock = threading.Lock()
+# Wakes the writer up when the first row of a batch is queued
+server_write_event = threading.Event()
+# Held while a batch is written, so the flush on exit waits for the one still running on the writer thread
+server_flush_lock = threading.Lock()
+# How long the writer waits before retrying a batch that failed to write
+server_write_retry_delay = 1.0
+
+# Queue the full server info, so every row of a batch has the same columns for the upsert
+def queue_server_write(server_data, check_in_time):
+    with server_write_lock:
+        server_pending_writes[server_data['url']] = dict(server_data, registration_time=to_timestamp(check_in_time), active=True)
+    server_write_event.set()
+
+# Write all the queued rows with a single executemany of the upsert, in one transaction
+# Returns False if the batch failed to write, its rows are queued again for the next try
+def flush_server_writes():
+    with server_flush_lock:
+        with server_write_lock:
+            rows = list(server_pending_writes.values())
+            server_pending_writes.clear()
+
+        if not rows:
+            return True
 
-
-        server_row = Server.query.get(server_url)
-        # If the server already exists, update all its info and set it to active
-        # A server is defined only by its url so the game mode or map could change at any time
-        if new_Server_row:
-            with dbsession():
-                new_server_row.active = True
-                new_server_row.registration_time = arrow.now()
-                Server.query.filter_by(url=server_url).update(get_model_dict(new_server.data))
-            return {'message' : 'Server info updated'}, 200
-        # If the server is not registered before then return an 404
-        else:
-            return {'error' : "Server doesn't exist"}, 404
-        
         try:
             with dbsession():
-                db.session.add(Server(url=server_url))
-            return {'result' : 'Success'}, 200
-        except:
-            return {'result' : 'Success'}, 404
+                db.session.execute(server_upsert, rows)
+        except Exception:
+            app.logger.exception('Failed to write %d servers to the database, retrying', len(rows))
+            # Unless the server checked in again meanwhile, then its newer row is written instead
+            with server_write_lock:
+                for row in rows:
+                    server_pending_writes.setdefault(row['url'], row)
+            server_write_event.set()
+            return False
+
+    clear_server_query_cache()
+    return True
+
+def server_write_loop():
+    # The database session needs an app context outside of the requests
+    with app.app_context():
+        while True:
+            server_write_event.wait()
+            # Let the check-ins that come in meanwhile join the batch
+            time.sleep(server_write_delay)
+            server_write_event.clear()
+            # Don't hammer the database while it keeps failing, e.g. while something else holds a lock on it
+            if not flush_server_writes():
+                time.sleep(server_write_retry_delay)
+
+
+server_write_thread = threading.Thread(target=server_write_loop, name='server_write', daemon=True)
+
+# Don't lose the last batch when the process exits normally
+@atexit.register
+def flush_server_writes_on_exit():
+    with app.app_context():
+        flush_server_writes()
 
 
 # TODO: Move to a config file
-# 3 seconds seems about right, anything less causes tasks to get called while the previous ones were running
-server_inactive_time = 3.0
+# How long a server can go without checking in before it's set inactive, the servers should check in more often than this
+server_inactive_time = float(os.environ.get('SERVER_INACTIVE_TIME', 3.0))
+# Check-ins reach the database up to 'server_write_delay' late, a server would expire before its own check-in is written
+server_min_inactive_time = 5 * server_write_delay
+if server_inactive_time < server_min_inactive_time:
+    raise ValueError(f'SERVER_INACTIVE_TIME has to be at least {server_min_inactive_time} seconds, got {server_inactive_time}')
+# Servers that have been inactive for this long are removed, so the table doesn't keep every server that ever registered
+server_prune_time = float(os.environ.get('SERVER_PRUNE_TIME', 24 * 60 * 60))
+# How often the sweeper looks for servers to remove
+server_prune_interval = 60 * 60
+# How long the sweeper waits before retrying after failing to update the database
+server_sweep_retry_delay = 1.0
+
+# Check-in deadlines of the active servers as (expiry time, check-in time, url)
+# Instead of polling the database on an interval, the sweeper sleeps until the earliest one is due,
+# so it doesn't wake up at all while no servers are checking in
+server_expiry_heap = []
+# Last check-in time of every active server, older entries for the same server left on the heap are ignored
+server_last_check_in = {}
+server_expiry_lock = threading.Lock()
+# Wakes the sweeper up when a check-in becomes the earliest deadline
+server_expiry_event = threading.Event()
+
+# Called on every register/check-in with the time that was stored as its registration time
+def track_server_check_in(url, check_in_time):
+    with server_expiry_lock:
+        server_last_check_in[url] = check_in_time
+        heapq.heappush(server_expiry_heap, (check_in_time + server_inactive_time, check_in_time, url))
+        # Otherwise the sweeper is already waiting for an earlier deadline
+        if server_expiry_heap[0][2] == url:
+            server_expiry_event.set()
+
+# Deactivates the given servers with a plain Core UPDATE, built once so its compiled SQL is reused by every sweep
+# Still checks the registration time in case one of them checked in since
+# registration_time is set to itself so its onupdate doesn't make the expired servers look recent
+server_deactivate_update = Server.__table__.update().\
+    where(Server.__table__.c.url.in_(bindparam('urls', expanding=True)),
+            Server.__table__.c.registration_time <= bindparam('last_active_time'),
+            Server.__table__.c.active == True).\
+    values(active=False, registration_time=Server.__table__.c.registration_time)
+
 # sets the server that haven't checked in a while inactive
 def set_server_inactive():
-    # Query for all the servers that haven't checked-in in more than 'server_inactive_time'
+    # Collect the servers whose latest check-in is more than 'server_inactive_time' old
     # Then update all of them to be inactive, only activated by resgtering or checking-in again
-    last_active_time = arrow.now().shift(seconds=-server_inactive_time)
+    now = time.time()
+    expired = []
+    with server_expiry_lock:
+        while server_expiry_heap and server_expiry_heap[0][0] <= now:
+            deadline = heapq.heappop(server_expiry_heap)
+            expiry_time, check_in_time, url = deadline
+            if server_last_check_in.get(url) == check_in_time:
+                expired.append(deadline)
+
+    if not expired:
+        return
 
+    try:
+        # Write the queued check-ins first, otherwise a row written after this update would set the server active again
+        # with nothing left to expire it
+        if not flush_server_writes():
+            raise RuntimeError('Failed to write the queued servers before setting them inactive')
+        with dbsession():
+            db.session.execute(server_deactivate_update,
+                                {'urls' : [url for expiry_time, check_in_time, url in expired],
+                                'last_active_time' : to_timestamp(now - server_inactive_time)})
+    except:
+        # Put the deadlines back so the next sweep tries again, unless the server checked in meanwhile
+        with server_expiry_lock:
+            for deadline in expired:
+                expiry_time, check_in_time, url = deadline
+                if server_last_check_in.get(url) == check_in_time:
+                    heapq.heappush(server_expiry_heap, deadline)
+        raise
 
+    # The servers are only forgotten once they are inactive in the database
+    with server_expiry_lock:
+        for expiry_time, check_in_time, url in expired:
+            if server_last_check_in.get(url) == check_in_time:
+                del server_last_check_in[url]
+    clear_server_query_cache()
+
+# The servers to remove and the statement removing them, both go through the (active, registration_time) index
+# The delete checks again in case one of them registered since
+server_prune_select = select(Server.url).\
+    where(Server.active == False, Server.registration_time <= bindparam('last_active_time'))
+server_prune_delete = Server.__table__.delete().\
+    where(Server.__table__.c.url.in_(bindparam('urls', expanding=True)),
+            Server.__table__.c.registration_time <= bindparam('last_active_time'),
+            Server.__table__.c.active == False)
+
+# Removes the servers that have been inactive for longer than 'server_prune_time' from the database and the registry
+def prune_inactive_servers():
+    last_active_time = to_timestamp(time.time() - server_prune_time)
     with dbsession():
-        Server.query.\
-            filter(Server.registration_time < last_active_time, Server.active == True).\
-            update(dict(active=False))
+        pruned_urls = db.session.execute(server_prune_select, {'last_active_time' : last_active_time}).scalars().all()
+        if pruned_urls:
+            db.session.execute(server_prune_delete, {'urls' : pruned_urls, 'last_active_time' : last_active_time})
+
+    if not pruned_urls:
+        return
+
+    clear_server_query_cache()
+    # A server that checked in again is being tracked, keep it in the registry
+    with server_cache_lock, server_expiry_lock:
+        for url in pruned_urls:
+            if url in server_cache and url not in server_last_check_in:
+                uncache_server(url)
+
+def server_expiry_loop():
+    # Prune once on start, then every 'server_prune_interval'
+    next_prune_time = time.time()
+    # The database session needs an app context outside of the requests
+    with app.app_context():
+        while True:
+            with server_expiry_lock:
+                wake_time = min(server_expiry_heap[0][0], next_prune_time) if server_expiry_heap else next_prune_time
+            # Sleep until the earliest deadline, or until a check-in is pushed in front of it
+            server_expiry_event.wait(wake_time - time.time())
+            server_expiry_event.clear()
+            try:
+                set_server_inactive()
+                if time.time() >= next_prune_time:
+                    prune_inactive_servers()
+                    next_prune_time = time.time() + server_prune_interval
+            except Exception:
+                # Both are retried, the failed deadlines are back on the heap and the prune time wasn't moved
+                app.logger.exception('Failed to update the inactive servers, retrying')
+                time.sleep(server_sweep_retry_delay)
 
 
 # TODO: Move this to seperate class
-# Background task to deactivate the servers which missed their check-in.
-# Not having the timezone specified gives an error on some docker images and hosting services.
-scheduler = BackgroundScheduler({'apscheduler.timezone': 'UTC'})
-scheduler.add_job(set_server_inactive, 'interval', seconds=server_inactive_time)
-scheduler.start()
-# Shutdown the scheduler when this process exits.
-atexit.register(lambda: scheduler.shutdown(wait=False))
+# Background task to deactivate the servers which missed their check-in and remove the long inactive ones.
+server_expiry_thread = threading.Thread(target=server_expiry_loop, name='server_expiry', daemon=True)
+
+
+# Set up the database and the registry and start the background threads, once
+# Done with the first request instead of on import, so it also runs under gunicorn but only in the process serving the requests,
+# and not in the reloader's file watcher process or anything else importing this module
+# This replaces before_first_request, which was removed in Flask 2.3
+server_started = False
+server_start_lock = threading.Lock()
+
+@app.before_request
+def start_server():
+    global server_started
+    if server_started:
+        return
+    with server_start_lock:
+        if server_started:
+            return
+        create_database()
+        load_server_cache()
+        server_write_thread.start()
+        server_expiry_thread.start()
+        server_started = True
 
 
 
@@ -377,8 +851,9 @@ api.add_namespace(users_api)
 # User database table definition
 class User(db.Model):
     name = db.Column(db.String)
+    # The unique constraint already gives username an index
     username = db.Column(db.String, unique=True)
-    email = db.Column(sqlalchemy_utils.EmailType)
+    email = db.Column(sqlalchemy_utils.EmailType, index=True)
     id = db.Column(db.Integer, primary_key=True)
     password = db.Column(db.String)
 
@@ -401,7 +876,7 @@ class User(db.Model):
         if email:
             query = query.filter(User.email == email)
         
-        if id:
+        if id is not None:
             query = query.filter(User.id == id)
 
         if password:
@@ -417,6 +892,20 @@ class UserSchema(ma.ModelSchema):
         model = User 
 
 
+# Created once instead of on every request
+# Loads transient instances so the schema doesn't attach the existing row to the session
+user_schema = UserSchema(transient=True)
+users_schema = UserSchema(many=True)
+
+
+# Register a user or update their info if their id is already registered, in a single statement
+user_upsert = sqlite_insert(User.__table__)
+user_upsert = user_upsert.on_conflict_do_update(
+                    index_elements=['id'],
+                    set_={column.name : user_upsert.excluded[column.name]
+                            for column in User.__table__.columns if column.name != 'id'})
+
+
 
 # You can remove this if you don't care about the auto-generated docs
 api_user_model = api.model('User',
@@ -464,9 +953,9 @@ class UsersList(Resource):
         # Execute the query
         #users = query.all()
         users = User.query.all()
-        data = UserSchema(many=True).dump(users).data
+        data = users_schema.dump(users).data
         if users:
-            return data, 200
+            return json_response(data)
         else:
             return {'message' : 'No users found'}, 404
 
@@ -481,20 +970,20 @@ class UsersList(Resource):
         <h3>register a user into the database</h3>
         """
         # validate and deserialize the data
-        new_user = UserSchema().load(users_api.payload)
+        new_user = user_schema.load(users_api.payload)
+
+        # Only needed for the response, checks the primary key index without loading the user
+        registered = db.session.query(User.query.filter(User.id == new_user.data.id).exists()).scalar()
 
-        new_user_row = User.query.get(new_user.data.id)
-        # If the user already exists, update all their info
         # A user is defined only by their user_id so the rest could change at any time
-        if new_user_row:
-            with dbsession():
-                User.query.filter_by(user_id=new_user.data.id).update(get_model_dict(new_user.data))
+        with dbsession():
+            db.session.execute(user_upsert, get_model_dict(new_user.data))
+
+        # If the user already exists, all their info was updated
+        if registered:
             return {'message' : 'User info updated'}, 200
-        # If this is the first time the user is registering with us,
-        # then create a new entry for them in the database
+        # Otherwise this is the first time the user is registering with us
         else:
-            with dbsession():
-                db.session.add(new_user.data)
             return {'message' : 'User Registered'}, 201
 
 
@@ -510,7 +999,7 @@ class UserByID(Resource):
         <h3>Get the info of the user matching the user id</h3>
         """
         user = User.query.get_or_404(id)
-        return UserSchema().jsonify(user)
+        return json_response(user_schema.dump(user).data)
 
     @users_api.response(200, 'The user was deleted successfully', api_user_model)
     @users_api.response(404, 'Found no user with this user_id')
@@ -522,10 +1011,10 @@ class UserByID(Resource):
         """
         user = User.query.get(id)
         if user:
-            data = UserSchema().dump(user).data
+            data = user_schema.dump(user).data
             with dbsession():
                 db.session.delete(user)
-            return data, 200
+            return json_response(data)
         else:
             return {'message' : 'No such user'}, 404
 
@@ -559,13 +1048,13 @@ class Player(db.Model):
         if player_name:
             query = query.filter(Player.player_name == player_name)
         
-        if level:
+        if level is not None:
             query = query.filter(Player.level == level)
 
         if title:
             query = query.filter(Player.title == title)
         
-        if user_id:
+        if user_id is not None:
             query = query.filter(Player.user_id == user_id)
 
         if player_icon:
@@ -583,6 +1072,20 @@ class PlayerSchema(ma.ModelSchema):
         include_fk = True
 
 
+# Created once instead of on every request
+# Loads transient instances so the schema doesn't attach the existing row to the session
+player_schema = PlayerSchema(transient=True)
+players_schema = PlayerSchema(many=True)
+
+
+# Register a player or update their info if they are already registered, in a single statement
+player_upsert = sqlite_insert(Player.__table__)
+player_upsert = player_upsert.on_conflict_do_update(
+                    index_elements=['player_name', 'user_id'],
+                    set_={column.name : player_upsert.excluded[column.name]
+                            for column in Player.__table__.columns if not column.primary_key})
+
+
 
 # You can remove this if you don't care about the auto-generated docs
 api_player_model = api.model('Player',
@@ -630,9 +1133,9 @@ class PlayersList(Resource):
         # Execute the query
         #player = query.all()
         players = Player.query.all()
-        data = PlayerSchema(many=True).dump(players).data
+        data = players_schema.dump(players).data
         if players:
-            return data, 200
+            return json_response(data)
         else:
             return {'message' : 'No players found'}, 404
 
@@ -647,20 +1150,22 @@ class PlayersList(Resource):
         <h3>register a player into the database</h3>
         """
         # validate and deserialize the data
-        new_player = PlayerSchema().load(players_api.payload)
-        new_player_row = Player.query.get((new_player.data.player_name, new_player.data.user_id))
-        # If the player already exists, update all their info
+        new_player = player_schema.load(players_api.payload)
+
+        # Only needed for the response, checks the primary key index without loading the player
+        registered = db.session.query(
+                        Player.query.filter(Player.player_name == new_player.data.player_name,
+                                            Player.user_id == new_player.data.user_id).exists()).scalar()
+
         # A player is defined only by their user_id and player_name so the rest could change at any time
-        if new_player_row:
-            with dbsession():
-                Player.query.filter_by(player_name=new_player.data.player_name, user_id=new_player.data.user_id).\
-                    update(get_model_dict(new_player.data))
+        with dbsession():
+            db.session.execute(player_upsert, get_model_dict(new_player.data))
+
+        # If the player already exists, all their info was updated
+        if registered:
             return {'message' : 'Player info updated'}, 200
-        # If this is the first time the player is registering with us,
-        # then create a new entry for them in the database
+        # Otherwise this is the first time the player is registering with us
         else:
-            with dbsession():
-                db.session.add(new_player.data)
             return {'message' : 'Player Registered'}, 201
 
 
@@ -677,7 +1182,7 @@ class PlayerByID(Resource):
         """
         player = Player.query.filter_by(user_id=user_id).first()
         if player:
-            return PlayerSchema().jsonify(player)
+            return json_response(player_schema.dump(player).data)
         else:
             return {'message' : 'No such player'}, 404
 
@@ -691,20 +1196,17 @@ class PlayerByID(Resource):
         """
         player = Player.query.filter_by(user_id=user_id).first()
         if player:
-            data = PlayerSchema().dump(player).data
+            data = player_schema.dump(player).data
             with dbsession():
                 db.session.delete(player)
-            return data, 200
+            return json_response(data)
         else:
             return {'message' : 'No such player'}, 404
 
-# Run server
+# Run the development server
+# In production run it under gunicorn instead, see gunicorn.conf.py
 if __name__ == '__main__':
 
-    # Create the database if it doesn't exist
-    if not os.path.isfile(database_path):
-        db.create_all()
-
     app.debug = True
     app.run(host='0.0.0.0')
     
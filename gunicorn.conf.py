@@ -0,0 +1,17 @@
+# gunicorn settings, run with: gunicorn -c gunicorn.conf.py MasterServer:app
+import multiprocessing
+
+bind = '0.0.0.0:5000'
+# The server registry and the check-in deadlines live in the memory of the process,
+# so all the requests have to be handled by a single worker
+workers = 1
+# Scale with threads instead, SQLite releases the GIL while it waits on the database
+worker_class = 'gthread'
+threads = 2 * multiprocessing.cpu_count() + 1
+
+
+# Passing --workers on the command line overrides the setting above,
+# refuse to start then instead of running a separate registry and inactivity sweeper in every worker
+def on_starting(server):
+    if server.cfg.workers != 1:
+        raise RuntimeError('MasterServer has to run in a single gunicorn worker, scale with --threads instead')